@@ -0,0 +1,105 @@
+import io
+
+class PreviewFrame(object):
+    """Preview image held in the gphoto2 camera file buffer
+
+    Consumers borrow memoryviews of the buffer with acquire() and hand them back
+    with release(). The camera file is only dropped after the frame is closed and
+    every borrowed view has been released.
+    """
+
+    def __init__(self, camera_file, file_data):
+        self._camera_file = camera_file
+        self._buffer = memoryview(file_data)
+        self._size = self._buffer.nbytes
+        self._views = {}
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def leases(self):
+        return len(self._views)
+
+    @property
+    def freed(self):
+        return self._buffer is None
+
+    def acquire(self):
+        if self._buffer is None or self._closed:
+            raise ValueError("Preview frame is already closed")
+        view = self._buffer[:]
+        self._views[id(view)] = view
+        return view
+
+    def release(self, view):
+        if self._views.get(id(view)) is not view:
+            raise ValueError("View was not lent by this preview frame or is already released")
+        del self._views[id(view)]
+        view.release()
+        self._maybe_free()
+
+    def reader(self):
+        """File-like object for decoders, reads directly from the buffer"""
+        return PreviewFrameReader(self)
+
+    def tobytes(self):
+        # for writers that only accept bytes
+        view = self.acquire()
+        try:
+            return view.tobytes()
+        finally:
+            self.release(view)
+
+    def close(self):
+        self._closed = True
+        self._maybe_free()
+
+    def _maybe_free(self):
+        if self._closed and not self._views and self._buffer is not None:
+            self._buffer.release()
+            self._buffer = None
+            self._camera_file = None
+
+class PreviewFrameReader(io.RawIOBase):
+    """Seekable reader over a borrowed view of a PreviewFrame"""
+
+    def __init__(self, frame):
+        self._frame = frame
+        self._view = frame.acquire()
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = max(0, min(len(b), self._view.nbytes - self._pos))
+        b[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._view.nbytes
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if not self.closed:
+            self._frame.release(self._view)
+        super(PreviewFrameReader, self).close()
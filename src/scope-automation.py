@@ -2,6 +2,9 @@
 
 import itertools
 import glob
+import re
+import collections
+import concurrent.futures
 import subprocess
 import sys
 import readchar
@@ -12,14 +15,18 @@ import scipy.ndimage
 import numpy as np
 import numpy.fft
 import subprocess
+import urllib.parse
 import math
 import psutil
-import io
+import json
 import logging
 import gphoto2 as gp
 import imageio
+from PIL import Image, ImageDraw
+from preview_frame import PreviewFrame
 import scipy.optimize
 import tornado.ioloop
+import tornado.iostream
 import tornado.web
 import tornado.websocket
 import termios, tty
@@ -31,6 +38,7 @@ ARDUINO_PORT_GLOBS = ["/dev/tty.usbmodem14*", "/dev/tty.wchusbserial14*"]
 ARDUINO_SPEED = "115200"
 
 CAMERA = None
+CAMERA_SETTINGS = None
 DELTA = 40
 REFERENCE_FFT_RESULT = None
 REFERENCE_Z_POSITION = None
@@ -38,28 +46,127 @@ MAX_DELTA_TO_REFERENCE_Z_POSITION = 500
 Z_POSITION = 0
 AUTOFOCUS_BOUND = 50
 AUTOFOCUS_STEP = 5
+# correlations with the reference captured during autofocus, keyed by reference
+# and z position on a global AUTOFOCUS_STEP grid, entries older than
+# FOCUS_CACHE_MAX_AGE_S are captured again
+FOCUS_CACHE = {}
+FOCUS_CACHE_MAX_AGE_S = 300
+REFERENCE_ID = 0
 MOTOR_SLEEP_MULTIPLIER = 0.03
 TIMELAPSE_INTERVAL_MS = 5000
+Z_POSITIONS_FILE = "data/z-positions.txt"
+RENDER_FPS = 24
+RENDER_WIDTH = 1920
+# maximum number of decoded frames waiting for the encoder
+RENDER_WINDOW = 32
+# jogs arriving while the motor is busy are merged into a single move, at most one
+# move command is sent to the controller per JOG_MIN_INTERVAL_MS
+JOG_MIN_INTERVAL_MS = 50
+# largest move a single jog may request, also limits the total of merged jogs
+MAX_JOG_STEPS = 100
+JOG_PENDING_STEPS = 0
+JOG_FLUSH_HANDLE = None
+MOTOR_BUSY_UNTIL = 0
+# change detection timelapse: preview is checked every TIMELAPSE_INTERVAL_MS, the full
+# resolution image is only captured when the preview changed more than the threshold
+# (mean absolute difference of the downsampled grayscale preview, 0..1) or when
+# TIMELAPSE_MAX_INTERVAL_MS has passed since the last stored image
+TIMELAPSE_CHANGE_THRESHOLD = 0.02
+TIMELAPSE_MAX_INTERVAL_MS = 60000
+SIGNATURE_BLOCK_SIZE = 16
+LAST_STORED_SIGNATURE = None
+LAST_STORED_TIME = None
+LAST_STORED_Z = None
+TIMELAPSE_CHECKS = 0
+TIMELAPSE_STORES = 0
 
 class ImageWebSocket(tornado.websocket.WebSocketHandler):
     clients = set()
 
+    def initialize(self, arduino_serial):
+        self.arduino_serial = arduino_serial
+
     def check_origin(self, origin):
-        # Allow access from every origin
-        return True
+        # the socket moves the stage, so only accept pages served by this app
+        return super(ImageWebSocket, self).check_origin(origin)
 
     def open(self):
         ImageWebSocket.clients.add(self)
         log("WebSocket opened from: " + self.request.remote_ip)
+        self.write_message(json.dumps({"z": Z_POSITION}))
 
     def on_message(self, message):
-        jpeg_bytes = get_preview_image().getvalue()
-        self.write_message(jpeg_bytes, binary=True)
+        if not isinstance(message, str):
+            log("Ignoring binary message from {ip}".format(ip=self.request.remote_ip))
+            return
+        if message.startswith("{"):
+            try:
+                command = json.loads(message)
+            except ValueError as err:
+                log("Invalid command from {ip}: {err}".format(ip=self.request.remote_ip, err=err))
+                return
+            self.on_command(command)
+            return
+        # tornado frames the message as bytes, so this is the only copy of the preview
+        with get_preview_image() as frame:
+            self.write_message(frame.tobytes(), binary=True)
+
+    def on_command(self, command):
+        cmd = command.get("cmd") if isinstance(command, dict) else None
+        steps = command.get("steps") if cmd == "jog" else None
+        if cmd not in ("jog", "cancel"):
+            log("Unknown command from {ip}: {cmd}".format(ip=self.request.remote_ip, cmd=command))
+        elif cmd == "jog" and (isinstance(steps, bool) or not isinstance(steps, int)):
+            log("Invalid jog steps from {ip}: {steps}".format(ip=self.request.remote_ip, steps=steps))
+        elif self.arduino_serial is None:
+            log("No connection to scope controller, motor movements are disabled")
+        elif cmd == "jog":
+            jog_z(self.arduino_serial, max(-MAX_JOG_STEPS, min(MAX_JOG_STEPS, steps)))
+        else:
+            cancel_jog()
 
     def on_close(self):
         ImageWebSocket.clients.remove(self)
         log("WebSocket closed from: " + self.request.remote_ip)
 
+class SettingsHandler(tornado.web.RequestHandler):
+    # GET returns all camera settings, POST a JSON object of {name: value} to change them
+    def get(self):
+        if CAMERA_SETTINGS is None:
+            raise tornado.web.HTTPError(503, "No camera connected")
+        self.write(CAMERA_SETTINGS.values())
+
+    def post(self):
+        # settings change the camera, so like the WebSocket only accept pages served by this app
+        origin = self.request.headers.get("Origin")
+        if origin is not None and urllib.parse.urlparse(origin).netloc.lower() != self.request.host.lower():
+            raise tornado.web.HTTPError(403, "Cross origin requests are not allowed")
+        if CAMERA_SETTINGS is None:
+            raise tornado.web.HTTPError(503, "No camera connected")
+        try:
+            settings = json.loads(self.request.body)
+            if not isinstance(settings, dict):
+                raise ValueError("Expected a JSON object of settings")
+            for name, value in settings.items():
+                CAMERA_SETTINGS.set(name, value)
+        except (ValueError, TypeError, PeripheralStatusError) as err:
+            CAMERA_SETTINGS.discard()
+            raise tornado.web.HTTPError(400, getattr(err, "message", str(err)))
+        try:
+            CAMERA_SETTINGS.apply()
+        except gp.GPhoto2Error as err:
+            raise tornado.web.HTTPError(502, "Camera rejected settings: {err}".format(err=err))
+        self.write(CAMERA_SETTINGS.values())
+
+    def write_error(self, status_code, **kwargs):
+        # send the error message to the client instead of only logging it
+        error = self._reason
+        if "exc_info" in kwargs:
+            exception = kwargs["exc_info"][1]
+            if isinstance(exception, tornado.web.HTTPError) and exception.log_message:
+                error = exception.log_message
+        self.finish({"error": error})
+
 class Error(Exception):
     """Base class for exceptions in this module."""
     pass
@@ -84,6 +191,93 @@ class SystemError(Error):
     def __init__(self, message):
         self.message = message
 
+class CameraSettings(object):
+    """Camera configuration tree read once and indexed by widget name
+
+    Changes are queued with set() and written to the camera with a single
+    gp_camera_set_config() call in apply().
+    """
+
+    VALUE_TYPES = (gp.GP_WIDGET_TEXT, gp.GP_WIDGET_RANGE, gp.GP_WIDGET_TOGGLE,
+                   gp.GP_WIDGET_RADIO, gp.GP_WIDGET_MENU, gp.GP_WIDGET_DATE)
+
+    def __init__(self, camera):
+        self._camera = camera
+        self._pending = {}
+        self.refresh()
+
+    def refresh(self):
+        self._config = gp.check_result(gp.gp_camera_get_config(self._camera))
+        self._widgets = {}
+        self._index(self._config)
+
+    def _index(self, widget):
+        for i in range(gp.check_result(gp.gp_widget_count_children(widget))):
+            child = gp.check_result(gp.gp_widget_get_child(widget, i))
+            if gp.check_result(gp.gp_widget_get_type(child)) in self.VALUE_TYPES:
+                self._widgets[gp.check_result(gp.gp_widget_get_name(child))] = child
+            self._index(child)
+
+    def __contains__(self, name):
+        return name in self._widgets
+
+    def _widget(self, name):
+        if name not in self._widgets:
+            raise PeripheralStatusError("Camera has no setting {name}".format(name=name))
+        return self._widgets[name]
+
+    def get(self, name):
+        return gp.check_result(gp.gp_widget_get_value(self._widget(name)))
+
+    def choices(self, name):
+        widget = self._widget(name)
+        if gp.check_result(gp.gp_widget_get_type(widget)) not in (gp.GP_WIDGET_RADIO, gp.GP_WIDGET_MENU):
+            return None
+        return [gp.check_result(gp.gp_widget_get_choice(widget, i))
+                for i in range(gp.check_result(gp.gp_widget_count_choices(widget)))]
+
+    def values(self):
+        return dict((name, self.get(name)) for name in self._widgets)
+
+    def set(self, name, value):
+        widget = self._widget(name)
+        if gp.check_result(gp.gp_widget_get_readonly(widget)):
+            raise PeripheralStatusError("Camera setting {name} is read-only".format(name=name))
+        widget_type = gp.check_result(gp.gp_widget_get_type(widget))
+        if widget_type == gp.GP_WIDGET_RANGE:
+            value = float(value)
+            low, high, increment = gp.check_result(gp.gp_widget_get_range(widget))
+            if not low <= value <= high:
+                raise PeripheralStatusError("Invalid value {value} for {name}, range is {low} to {high}".format(
+                    value=value, name=name, low=low, high=high))
+        elif widget_type in (gp.GP_WIDGET_TOGGLE, gp.GP_WIDGET_DATE):
+            value = int(value)
+        else:
+            value = str(value)
+            choices = self.choices(name)
+            if choices is not None and value not in choices:
+                raise PeripheralStatusError("Invalid value {value} for {name}, choices are {choices}".format(
+                    value=value, name=name, choices=", ".join(choices)))
+        self._pending[name] = value
+
+    def discard(self):
+        self._pending = {}
+
+    def apply(self):
+        if not self._pending:
+            return
+        log("Applying camera settings {settings}".format(settings=self._pending))
+        try:
+            for name, value in self._pending.items():
+                gp.check_result(gp.gp_widget_set_value(self._widgets[name], value))
+            gp.check_result(gp.gp_camera_set_config(self._camera, self._config))
+        except gp.GPhoto2Error:
+            # the cached tree may hold values the camera rejected, read it again
+            self._pending = {}
+            self.refresh()
+            raise
+        self._pending = {}
+
 def flatten(list2d):
   return list(itertools.chain(*list2d))
 
@@ -98,8 +292,9 @@ def kill_ptpcamera():
                                                                                       pid=proc.pid))
       proc.kill()
 
-def sample_and_fft(image_data):
-  img = imageio.imread(image_data, "JPEG-PIL")
+def sample_and_fft(frame):
+  with frame.reader() as reader:
+    img = imageio.imread(reader, "JPEG-PIL")
   res = None
   for i in range(0, img.shape[0], DELTA):
     vec = np.absolute(numpy.fft.fft(img[:][i].flatten()))**2
@@ -109,15 +304,29 @@ def sample_and_fft(image_data):
       res = np.concatenate([res, vec])
   return res
 
+def preview_signature(frame):
+  with frame.reader() as reader:
+    img = imageio.imread(reader, "JPEG-PIL").astype(np.float32)
+  if img.ndim == 3:
+    img = img.mean(axis=2)
+  # downsample by averaging SIGNATURE_BLOCK_SIZE x SIGNATURE_BLOCK_SIZE blocks
+  h = img.shape[0] // SIGNATURE_BLOCK_SIZE * SIGNATURE_BLOCK_SIZE
+  w = img.shape[1] // SIGNATURE_BLOCK_SIZE * SIGNATURE_BLOCK_SIZE
+  blocks = img[:h, :w].reshape(h // SIGNATURE_BLOCK_SIZE, SIGNATURE_BLOCK_SIZE, w // SIGNATURE_BLOCK_SIZE, SIGNATURE_BLOCK_SIZE)
+  return blocks.mean(axis=(1, 3)) / 255.0
+
+def signature_change_score(signature, reference):
+  if reference is None or signature.shape != reference.shape:
+    return 1.0
+  return float(np.mean(np.absolute(signature - reference)))
+
 def image_filename():
   return "data/image-{count}.jpg".format(count=math.trunc(time() * 1000))
 
 def get_preview_image():
   camera_file = gp.check_result(gp.gp_camera_capture_preview(CAMERA))
   file_data = gp.check_result(gp.gp_file_get_data_and_size(camera_file))
-  buf =	io.BytesIO(file_data)
-  buf.seek(0) 
-  return buf
+  return PreviewFrame(camera_file, file_data)
 
 def get_store_and_maybe_show_image(show_image=False):
   file_path = gp.check_result(gp.gp_camera_capture(CAMERA, gp.GP_CAPTURE_IMAGE))
@@ -126,24 +335,119 @@ def get_store_and_maybe_show_image(show_image=False):
   log('Copying image to {target}'.format(target=target))
   camera_file = gp.check_result(gp.gp_camera_file_get(CAMERA, file_path.folder, file_path.name, gp.GP_FILE_TYPE_NORMAL))
   gp.check_result(gp.gp_file_save(camera_file, target))
+  with open(Z_POSITIONS_FILE, "a") as f:
+    f.write("{name} {z}\n".format(name=os.path.basename(target), z=Z_POSITION))
   if show_image:
     subprocess.call(['open', target])
   return target
 
+def timelapse_images():
+  images = []
+  for path in glob.glob("data/image-*.jpg"):
+    match = re.search(r"image-(\d+)\.jpg$", path)
+    if match:
+      images.append((int(match.group(1)), path))
+  return sorted(images)
+
+def load_z_positions():
+  positions = {}
+  if os.path.exists(Z_POSITIONS_FILE):
+    with open(Z_POSITIONS_FILE) as f:
+      for line in f:
+        # skip blank or truncated lines left by an interrupted run
+        try:
+          name, z = line.split()
+          positions[name] = int(z)
+        except ValueError:
+          continue
+  return positions
+
+def render_frame(path, timestamp_ms, z, width, overlay):
+  # returns None for images that can not be decoded, e.g. truncated by an interrupted run
+  try:
+    img = Image.open(path)
+    # ffmpeg wants dimensions that are a multiple of 16
+    height = max(16, int(round(img.height * width / float(img.width) / 16)) * 16)
+    # let the JPEG decoder scale down while decoding
+    img.draft("RGB", (width, height))
+    img = img.convert("RGB")
+    img = img.resize((width, height), Image.BILINEAR)
+  except OSError as err:
+    log("Skipping unreadable image {path}: {err}".format(path=path, err=err))
+    return None
+  if overlay:
+    text = strftime("%Y-%m-%d %H:%M:%S", localtime(timestamp_ms / 1000.0))
+    if z is not None:
+      text += "  Z: {z}".format(z=z)
+    draw = ImageDraw.Draw(img)
+    draw.text((11, 11), text, fill=(0, 0, 0))
+    draw.text((10, 10), text, fill=(255, 255, 255))
+  return np.asarray(img)
+
+def render_timelapse(target, fps=RENDER_FPS, width=RENDER_WIDTH, overlay=True):
+  images = timelapse_images()
+  if not images:
+    raise SystemError("No timelapse images found in data/")
+  width = width // 16 * 16
+  positions = load_z_positions()
+  log("Rendering {count} images to {target}".format(count=len(images), target=target))
+  # frames are decoded in parallel, but at most RENDER_WINDOW are kept in memory
+  in_flight = collections.deque()
+  with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as pool, \
+       imageio.get_writer(target, fps=fps) as writer:
+    def write_next_frame(written):
+      frame = in_flight.popleft().result()
+      if frame is not None:
+        writer.append_data(frame)
+      if written % 100 == 0 or written == len(images):
+        log("Rendered {count}/{total}".format(count=written, total=len(images)))
+
+    written = 0
+    for timestamp_ms, path in images:
+      z = positions.get(os.path.basename(path))
+      in_flight.append(pool.submit(render_frame, path, timestamp_ms, z, width, overlay))
+      if len(in_flight) >= RENDER_WINDOW:
+        written += 1
+        write_next_frame(written)
+    while in_flight:
+      written += 1
+      write_next_frame(written)
+  log("Rendered {target}".format(target=target))
+
 def current_position_take_preview_image_and_set_as_reference():
-  global REFERENCE_FFT_RESULT, REFERENCE_Z_POSITION
-  image = get_preview_image()
-  REFERENCE_FFT_RESULT = sample_and_fft(image)
+  global REFERENCE_FFT_RESULT, REFERENCE_Z_POSITION, REFERENCE_ID
+  with get_preview_image() as frame:
+    REFERENCE_FFT_RESULT = sample_and_fft(frame)
   REFERENCE_Z_POSITION = Z_POSITION
+  REFERENCE_ID += 1
+  invalidate_focus_cache("new reference")
   log("Using current position {pos} as reference".format(pos=Z_POSITION))
 
 def current_position_take_preview_image_and_get_correlation_with_reference():
-  image = get_preview_image()
-  fft_result = sample_and_fft(image)
+  with get_preview_image() as frame:
+    fft_result = sample_and_fft(frame)
   corr = np.corrcoef(REFERENCE_FFT_RESULT, fft_result)[1,0]
   log("Captured image position {pos} correlation {corr}".format(pos=Z_POSITION, corr=corr))
   return corr
 
+def cached_focus_score(z):
+  entry = FOCUS_CACHE.get((REFERENCE_ID, z))
+  if entry is None:
+    return None
+  corr, captured = entry
+  if time() - captured > FOCUS_CACHE_MAX_AGE_S:
+    del FOCUS_CACHE[(REFERENCE_ID, z)]
+    return None
+  return corr
+
+def cache_focus_score(z, corr):
+  FOCUS_CACHE[(REFERENCE_ID, z)] = (corr, time())
+
+def invalidate_focus_cache(reason):
+  if FOCUS_CACHE:
+    log("Clearing {count} cached focus scores, {reason}".format(count=len(FOCUS_CACHE), reason=reason))
+  FOCUS_CACHE.clear()
+
 def setup_arduino():
   for arduino_port in flatten([glob.glob(x) for x in ARDUINO_PORT_GLOBS]):
     try:
@@ -160,35 +464,27 @@ def connect_arduino():
   return ser
   
 def connect_camera():
-  global CAMERA
+  global CAMERA, CAMERA_SETTINGS
   logging.basicConfig(format='%(levelname)s: %(name)s: %(message)s', level=logging.ERROR)
   gp.check_result(gp.use_python_logging())
   CAMERA = gp.check_result(gp.gp_camera_new())
   gp.check_result(gp.gp_camera_init(CAMERA))
 
   log("Checking camera config")
-  # get configuration tree
-  config = gp.check_result(gp.gp_camera_get_config(CAMERA))
-  # find the image format config item
-  OK, image_format = gp.gp_widget_get_child_by_name(config, 'imageformat')
-  if OK >= gp.GP_OK:
-      # get current setting
-      value = gp.check_result(gp.gp_widget_get_value(image_format))
-      # make sure it's not raw
-      if 'raw' in value.lower():
+  # get configuration tree, kept for later setting changes
+  CAMERA_SETTINGS = CameraSettings(CAMERA)
+  # make sure the image format is not raw
+  if 'imageformat' in CAMERA_SETTINGS:
+      if 'raw' in CAMERA_SETTINGS.get('imageformat').lower():
           raise PeripheralStatusError('Camera is setup to record raw, but we need previs, and preview does not work with raw images')
-  # find the capture size class config item
+  # set the capture size class
   # need to set this on my Canon 350d to get preview to work at all
-  OK, capture_size_class = gp.gp_widget_get_child_by_name( config, 'capturesizeclass')
-  if OK >= gp.GP_OK:
-      # set value
-      value = gp.check_result(gp.gp_widget_get_choice(capture_size_class, 2))
-      gp.check_result(gp.gp_widget_set_value(capture_size_class, value))
-      # set config
-      gp.check_result(gp.gp_camera_set_config(CAMERA, config))
+  if 'capturesizeclass' in CAMERA_SETTINGS:
+      CAMERA_SETTINGS.set('capturesizeclass', CAMERA_SETTINGS.choices('capturesizeclass')[2])
+      CAMERA_SETTINGS.apply()
 
 def ready():
-  log("Ready, ctrl-c = quit, a = -1, z = +1, t = timelapse, s = shoot and show image, r = use current position as reference, f = find position with highest correlation with reference")
+  log("Ready, ctrl-c = quit, a = -1, z = +1, x = cancel pending moves, t = timelapse, c = change detection timelapse, g = stop timelapse, s = shoot and show image, r = use current position as reference, f = find position with highest correlation with reference")
 
 def serial_writeline(ser, data):
   log("ARDUINO -> {data}".format(data=data))
@@ -214,32 +510,115 @@ def camera_shutter(ser):
   if data != "OK S":
     raise PeripheralStatusError("Camera focus returned error: {}".format(data))
 
-def move_z(ser, value):
+def publish_z_position():
+  message = json.dumps({"z": Z_POSITION})
+  for client in list(ImageWebSocket.clients):
+    try:
+      client.write_message(message)
+    except (tornado.websocket.WebSocketClosedError, tornado.iostream.StreamClosedError):
+      pass
+
+# send move command without waiting, returns the time the motor needs for the move
+def send_move_z(ser, value):
   global Z_POSITION, REFERENCE_Z_POSITION, MAX_DELTA_TO_REFERENCE_Z_POSITION
   if REFERENCE_Z_POSITION is not None:
-    if abs(Z_POSITION - REFERENCE_Z_POSITION) > MAX_DELTA_TO_REFERENCE_Z_POSITION:
+    # moves back towards the reference are always allowed
+    delta = abs(Z_POSITION + value - REFERENCE_Z_POSITION)
+    if delta > MAX_DELTA_TO_REFERENCE_Z_POSITION and delta > abs(Z_POSITION - REFERENCE_Z_POSITION):
         raise PeripheralStatusError("Reached maximum delta to reference z position")
   Z_POSITION += value
   serial_writeline(ser, "M" + str(value))
-  sleep(MOTOR_SLEEP_MULTIPLIER * abs(value))
   log("Z: {z}".format(z=Z_POSITION))
+  # publish from the IOLoop so a failing client never interrupts a move
+  tornado.ioloop.IOLoop.current().add_callback(publish_z_position)
+  return MOTOR_SLEEP_MULTIPLIER * abs(value)
+
+def move_z(ser, value):
+  # let a jog in progress finish first
+  wait = MOTOR_BUSY_UNTIL - time()
+  if wait > 0:
+    sleep(wait)
+  sleep(send_move_z(ser, value))
+
+def jog_z(ser, steps):
+  global JOG_PENDING_STEPS
+  JOG_PENDING_STEPS = max(-MAX_JOG_STEPS, min(MAX_JOG_STEPS, JOG_PENDING_STEPS + steps))
+  schedule_jog(ser)
+
+# shorten a move so it stops at the maximum delta to the reference z position
+def limit_move_to_reference(value):
+  if REFERENCE_Z_POSITION is None:
+    return value
+  low = min(REFERENCE_Z_POSITION - MAX_DELTA_TO_REFERENCE_Z_POSITION, Z_POSITION)
+  high = max(REFERENCE_Z_POSITION + MAX_DELTA_TO_REFERENCE_Z_POSITION, Z_POSITION)
+  return max(low, min(high, Z_POSITION + value)) - Z_POSITION
+
+def schedule_jog(ser):
+  global JOG_FLUSH_HANDLE
+  if JOG_FLUSH_HANDLE is not None:
+    return
+  delay = max(0, MOTOR_BUSY_UNTIL - time())
+  JOG_FLUSH_HANDLE = tornado.ioloop.IOLoop.current().call_later(delay, flush_jog, ser)
+
+def flush_jog(ser):
+  global JOG_PENDING_STEPS, JOG_FLUSH_HANDLE, MOTOR_BUSY_UNTIL
+  JOG_FLUSH_HANDLE = None
+  steps = limit_move_to_reference(JOG_PENDING_STEPS)
+  if steps != JOG_PENDING_STEPS:
+    log("Limiting move of {steps} steps to maximum delta to reference z position".format(steps=JOG_PENDING_STEPS))
+  JOG_PENDING_STEPS = 0
+  if steps == 0:
+    return
+  try:
+    duration = send_move_z(ser, steps)
+  except PeripheralStatusError as err:
+    log(err.message)
+    return
+  MOTOR_BUSY_UNTIL = time() + max(duration, JOG_MIN_INTERVAL_MS / 1000.0)
+
+# drop jogs that have not been sent yet, a move already sent to the controller
+# cannot be interrupted
+def cancel_jog():
+  global JOG_PENDING_STEPS, JOG_FLUSH_HANDLE
+  if JOG_PENDING_STEPS != 0:
+    log("Cancelling pending move of {steps} steps".format(steps=JOG_PENDING_STEPS))
+  JOG_PENDING_STEPS = 0
+  if JOG_FLUSH_HANDLE is not None:
+    tornado.ioloop.IOLoop.current().remove_timeout(JOG_FLUSH_HANDLE)
+    JOG_FLUSH_HANDLE = None
 
 def find_position_with_lowest_correlation_with_reference(ser, level=1):
   # bail out if we are moving more than 5 * (AUTOFOCUS_BOUND / 2)
   if level > 5:
     raise PeripheralStatusError("Reached maximum limit for autofocus")
 
-  # start capturing images from -AUTOFOCUS_BOUND
-  move_z(ser, -1 * AUTOFOCUS_BOUND)
+  # a jog sent after autofocus would move away from the position found
+  if level == 1:
+    cancel_jog()
+
+  start = Z_POSITION
+  # scan positions are snapped to multiples of AUTOFOCUS_STEP so runs starting
+  # from different z positions hit the same cache entries
+  grid_start = int(round(start / float(AUTOFOCUS_STEP))) * AUTOFOCUS_STEP
 
-  # find correlations for positions [-AUTOFOCUS_BOUND, AUTOFOCUS_BOUND]
-  xa = range(-1 * AUTOFOCUS_BOUND, AUTOFOCUS_BOUND, AUTOFOCUS_STEP)
+  # find correlations for positions [-AUTOFOCUS_BOUND, AUTOFOCUS_BOUND] around start,
+  # only move to and capture positions that are not in the focus cache
+  xa = []
   ya = []
 
-  for x in xa:
-    move_z(ser, AUTOFOCUS_STEP)
-    corr = current_position_take_preview_image_and_get_correlation_with_reference()
-    log("Index %d has correlation %r)" % (x, corr))
+  for offset in range(-1 * AUTOFOCUS_BOUND, AUTOFOCUS_BOUND, AUTOFOCUS_STEP):
+    pos = grid_start + offset + AUTOFOCUS_STEP
+    # polyfit and new_pos are relative to start
+    x = pos - start
+    xa.append(x)
+    corr = cached_focus_score(pos)
+    if corr is None:
+      move_z(ser, pos - Z_POSITION)
+      corr = current_position_take_preview_image_and_get_correlation_with_reference()
+      cache_focus_score(pos, corr)
+      log("Index %d has correlation %r)" % (x, corr))
+    else:
+      log("Index %d has cached correlation %r)" % (x, corr))
     ya.append(corr)
 
   # fit correlations on a 2-degree polynomial
@@ -250,12 +629,11 @@ def find_position_with_lowest_correlation_with_reference(ser, level=1):
   result = scipy.optimize.minimize_scalar(-1 * p, method='bounded', bounds=[-1 * AUTOFOCUS_BOUND, AUTOFOCUS_BOUND])
   new_pos = round(result.x)
 
-  # we are close to the start or end of the range, move to
+  # move to the best position, search again around it if we are close to the start or end of the range
+  if start + new_pos != Z_POSITION:
+    move_z(ser, start + new_pos - Z_POSITION)
   if abs(new_pos) + 3 > AUTOFOCUS_BOUND:
-    move_z(ser, -1 * AUTOFOCUS_BOUND + new_pos)
     find_position_with_lowest_correlation_with_reference(ser, level + 1)
-  else:
-    move_z(ser, -1 * AUTOFOCUS_BOUND + new_pos)
 
 def setup():
   try:
@@ -285,25 +663,68 @@ def read_key(fd):
 def timelapse():
     get_store_and_maybe_show_image(False)
 
-def keyboard_control(fd, arduino_serial, timelapse_callback):
+def change_detection_timelapse():
+  global LAST_STORED_SIGNATURE, LAST_STORED_TIME, LAST_STORED_Z, TIMELAPSE_CHECKS, TIMELAPSE_STORES
+  TIMELAPSE_CHECKS += 1
+  with get_preview_image() as frame:
+    signature = preview_signature(frame)
+  score = signature_change_score(signature, LAST_STORED_SIGNATURE)
+  now = time()
+  expired = LAST_STORED_TIME is None or (now - LAST_STORED_TIME) * 1000 >= TIMELAPSE_MAX_INTERVAL_MS
+  # the preview also changes when the stage moves, so only a change at the z of the
+  # last stored image counts as the sample changing; changes while the timelapse
+  # is not running are not detected, use a new reference to reset the cache then
+  if score >= TIMELAPSE_CHANGE_THRESHOLD and LAST_STORED_SIGNATURE is not None and Z_POSITION == LAST_STORED_Z:
+    invalidate_focus_cache("sample changed")
+  if score >= TIMELAPSE_CHANGE_THRESHOLD or expired:
+    target = get_store_and_maybe_show_image(False)
+    LAST_STORED_SIGNATURE = signature
+    LAST_STORED_TIME = now
+    LAST_STORED_Z = Z_POSITION
+    TIMELAPSE_STORES += 1
+    log("Stored {target}, change score {score:.4f}{reason}".format(target=target, score=score,
+                                                                  reason=" (max interval)" if score < TIMELAPSE_CHANGE_THRESHOLD else ""))
+  else:
+    log("Skipped capture, change score {score:.4f}".format(score=score))
+  log("Timelapse stored {stores} of {checks} checks, compression {ratio:.1f}x".format(stores=TIMELAPSE_STORES,
+                                                                                       checks=TIMELAPSE_CHECKS,
+                                                                                       ratio=TIMELAPSE_CHECKS / float(max(TIMELAPSE_STORES, 1))))
+
+def reset_change_detection_timelapse():
+  global LAST_STORED_SIGNATURE, LAST_STORED_TIME, LAST_STORED_Z, TIMELAPSE_CHECKS, TIMELAPSE_STORES
+  LAST_STORED_SIGNATURE = None
+  LAST_STORED_TIME = None
+  LAST_STORED_Z = None
+  TIMELAPSE_CHECKS = 0
+  TIMELAPSE_STORES = 0
+
+def keyboard_control(fd, arduino_serial, timelapse_callback, change_timelapse_callback):
   ready()
   ch = read_key(fd)
   if ch == 'a':
     if arduino_serial is None:
       log("No connection to scope controller, motor movements are disabled")
     else:
-      move_z(arduino_serial, -1) 
+      jog_z(arduino_serial, -1)
   elif ch == 'z':
     if arduino_serial is None:
       log("No connection to scope controller , motor movements are disabled")
     else:
-      move_z(arduino_serial, 1)
+      jog_z(arduino_serial, 1)
+  elif ch == 'x':
+    cancel_jog()
   elif ch == 't':
     log("Starting timelapse, interval between takes is {iv} ms".format(iv=TIMELAPSE_INTERVAL_MS))
     timelapse_callback.start()
+  elif ch == 'c':
+    log("Starting change detection timelapse, checking every {iv} ms, threshold {th}, max interval {mx} ms".format(
+      iv=TIMELAPSE_INTERVAL_MS, th=TIMELAPSE_CHANGE_THRESHOLD, mx=TIMELAPSE_MAX_INTERVAL_MS))
+    reset_change_detection_timelapse()
+    change_timelapse_callback.start()
   elif ch == 'g':
     log("Stopping timelapse")
     timelapse_callback.stop()
+    change_timelapse_callback.stop()
   elif ch == 's':
     get_store_and_maybe_show_image(True)
   elif ch == 'r':
@@ -318,10 +739,16 @@ if __name__ == "__main__":
   script_path = os.path.dirname(os.path.realpath(__file__))
   static_path = script_path + '/static/'
 
+  # render data/image-*.jpg to a movie instead of starting the scope controller
+  if len(sys.argv) > 1 and sys.argv[1] == "render":
+    render_timelapse(sys.argv[2] if len(sys.argv) > 2 else "data/timelapse.mp4")
+    sys.exit(0)
+
   arduino_serial = setup()
 
   app = tornado.web.Application([
-      (r"/websocket", ImageWebSocket),
+      (r"/websocket", ImageWebSocket, {'arduino_serial': arduino_serial}),
+      (r"/settings", SettingsHandler),
       (r"/(.*)", tornado.web.StaticFileHandler, {'path': static_path, 'default_filename': 'index.html'}),
   ])
   app.listen(LISTEN_PORT)
@@ -333,9 +760,13 @@ if __name__ == "__main__":
     timelapse, 
     TIMELAPSE_INTERVAL_MS)
 
+  change_timelapse_callback = tornado.ioloop.PeriodicCallback(
+    change_detection_timelapse,
+    TIMELAPSE_INTERVAL_MS)
+
   tornado.ioloop.IOLoop.current().add_handler(
     sys.stdin, 
-    lambda fd, events: keyboard_control(fd, arduino_serial, timelapse_callback),
+    lambda fd, events: keyboard_control(fd, arduino_serial, timelapse_callback, change_timelapse_callback),
     tornado.ioloop.IOLoop.READ|tornado.ioloop.IOLoop.ERROR)
 
   log("Starting server: http://localhost:" + str(LISTEN_PORT) + "/")
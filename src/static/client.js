@@ -1,5 +1,6 @@
 var img = document.getElementById("liveImg");
 var fpsText = document.getElementById("fps");
+var zText = document.getElementById("z");
 
 var target_fps = 24;
 
@@ -35,7 +36,23 @@ ws.onopen = function() {
     requestImage();
 };
 
+function jog(steps) {
+    ws.send(JSON.stringify({cmd: "jog", steps: steps}));
+}
+
+function cancelJog() {
+    ws.send(JSON.stringify({cmd: "cancel"}));
+}
+
 ws.onmessage = function(evt) {
+    if (typeof evt.data === "string") {
+        var status = JSON.parse(evt.data);
+        if (status.z !== undefined) {
+            zText.textContent = status.z;
+        }
+        return;
+    }
+
     var arrayBuffer = evt.data;
     var blob  = new Blob([new Uint8Array(arrayBuffer)], {type: "image/jpeg"});
     img.src = window.URL.createObjectURL(blob);
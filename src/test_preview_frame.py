@@ -0,0 +1,76 @@
+import io
+
+import pytest
+
+from preview_frame import PreviewFrame
+
+def make_frame(data):
+  return PreviewFrame(None, data)
+
+def test_views_share_the_camera_buffer():
+  data = bytearray(b"0123456789")
+  frame = make_frame(data)
+  view = frame.acquire()
+  assert view.obj is data
+  data[0:1] = b"x"
+  assert view[0:1] == b"x"
+  frame.release(view)
+
+def test_reader_reads_from_the_camera_buffer():
+  data = bytearray(b"0123456789")
+  with make_frame(data) as frame:
+    reader = frame.reader()
+    data[0:4] = b"abcd"
+    assert reader.read(4) == b"abcd"
+    reader.close()
+
+def test_reader_seek_past_end_reads_nothing():
+  with make_frame(bytearray(10)) as frame:
+    with frame.reader() as reader:
+      reader.seek(20)
+      assert reader.read(4) == b""
+      reader.seek(-2, io.SEEK_END)
+      assert reader.read(4) == b"\x00\x00"
+
+def test_buffer_freed_after_close_and_last_release():
+  frame = make_frame(bytearray(10))
+  view = frame.acquire()
+  reader = frame.reader()
+  assert frame.leases == 2
+  frame.close()
+  assert not frame.freed
+  frame.release(view)
+  assert not frame.freed
+  reader.close()
+  assert frame.leases == 0
+  assert frame.freed
+  assert len(frame) == 10
+
+def test_acquire_after_close_fails():
+  frame = make_frame(bytearray(10))
+  frame.close()
+  with pytest.raises(ValueError):
+    frame.acquire()
+
+def test_release_rejects_foreign_and_double_release():
+  frame = make_frame(bytearray(10))
+  other = make_frame(bytearray(10))
+  view = frame.acquire()
+  with pytest.raises(ValueError):
+    other.release(view)
+  frame.release(view)
+  with pytest.raises(ValueError):
+    frame.release(view)
+  assert frame.leases == 0
+
+def test_decode_through_reader_releases_the_frame():
+  imageio = pytest.importorskip("imageio")
+  Image = pytest.importorskip("PIL.Image")
+  jpeg = io.BytesIO()
+  Image.new("RGB", (32, 16), (200, 100, 50)).save(jpeg, "JPEG")
+  with make_frame(bytearray(jpeg.getvalue())) as frame:
+    with frame.reader() as reader:
+      img = imageio.imread(reader, "JPEG-PIL")
+  assert img.shape == (16, 32, 3)
+  assert frame.leases == 0
+  assert frame.freed